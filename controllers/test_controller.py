@@ -4,16 +4,42 @@ import pox.lib.packet as pkt
 from pox.core import core
 from pox.lib.revent import *
 from pox.lib.util import dpid_to_str, str_to_dpid
+from pox.lib.addresses import EthAddr
 from pox.lib.recoco import Timer
 
+import json
+import os
+import time
+
 import networkx as nx
 
 log = core.getLogger()
 
 topo = nx.DiGraph()
 
+# Proactive flows only carry traffic until discovery has confirmed the
+# bootstrap links; then they are deleted and install_path routes again.
+# The hard timeout is a backstop: _reconcile hands over before it expires.
+BOOTSTRAP_PRIORITY = of.OFP_DEFAULT_PRIORITY - 1
+BOOTSTRAP_COOKIE = 0xb007
+BOOTSTRAP_HARD_TIMEOUT = 60
+
+def _link_key(dpid1, port1, dpid2, port2):
+    return tuple(sorted([(dpid1, port1), (dpid2, port2)]))
+
+def _link_dpids(key):
+    return set(dpid for dpid, port in key)
+
+def _remove_edge(dpid1, port1, dpid2, port2):
+    # topo holds one edge per switch pair, which may already belong to
+    # another link between the same switches
+    if topo.has_edge(dpid1, dpid2) and topo[dpid1][dpid2]['port'] == port1:
+        topo.remove_edge(dpid1, dpid2)
+    if topo.has_edge(dpid2, dpid1) and topo[dpid2][dpid1]['port'] == port2:
+        topo.remove_edge(dpid2, dpid1)
+
 class DijkstraController(EventMixin):
-    def __init__(self):
+    def __init__(self, bootstrap=None, link_timeout=15):
         self.listenTo(core.openflow)
         core.openflow_discovery.addListeners(self)
         self.mac_to_port = {}
@@ -22,17 +48,371 @@ class DijkstraController(EventMixin):
         self.bandwidth = 300
         Timer(self.update_interval, self._request_stats, recurring=True)
 
+        # Fast bootstrap: a topology file (written by topos/topo.py or a
+        # snapshot of the last discovered graph) replaces spanning_tree.
+        self.bootstrap = bootstrap
+        self.link_timeout = link_timeout
+        self.bootstrap_links = {}   # link key -> time it was loaded
+        self.bootstrap_hosts = {}   # mac -> (dpid, port)
+        self.bootstrap_switches = set()
+        self.bootstrap_mtime = None
+        self.snapshot_links = set() # link keys written to the snapshot
+        self.confirmed_links = set()
+        self.connect_time = {}      # dpid -> time of ConnectionUp
+        self.flood_state = {}       # dpid -> port -> no_flood
+        self.route_state = {}       # dpid -> mac -> port
+        self.first_connect = None
+        self.bootstrap_done = False
+        self.handed_over = False
+        self.snapshot_dirty = False
+        if self.bootstrap:
+            self._load_bootstrap()
+            Timer(self.update_interval, self._reconcile, recurring=True)
+
     def _handle_LinkEvent(self, event):
         link = event.link
+        key = _link_key(link.dpid1, link.port1, link.dpid2, link.port2)
         if event.added:
             bandwidth = self.bandwidth
             topo.add_edge(link.dpid1, link.dpid2, port=link.port1, weight=1.0 / bandwidth)
             topo.add_edge(link.dpid2, link.dpid1, port=link.port2, weight=1.0 / bandwidth)
+            self.confirmed_links.add(key)
+            if self.bootstrap:
+                # Discovery overrides whatever the file said about this pair
+                pair = _link_dpids(key)
+                for old in [k for k in self.bootstrap_links if _link_dpids(k) == pair]:
+                    del self.bootstrap_links[old]
+                for old in [k for k in self.snapshot_links if _link_dpids(k) == pair]:
+                    self.snapshot_links.discard(old)
+                self.snapshot_links.add(key)
+                self.snapshot_dirty = True
         elif event.removed:
-            if topo.has_edge(link.dpid1, link.dpid2):
-                topo.remove_edge(link.dpid1, link.dpid2)
-            if topo.has_edge(link.dpid2, link.dpid1):
-                topo.remove_edge(link.dpid2, link.dpid1)
+            _remove_edge(link.dpid1, link.port1, link.dpid2, link.port2)
+            self.confirmed_links.discard(key)
+            if self.bootstrap:
+                self.bootstrap_links.pop(key, None)
+                # Links dropped because a switch went away stay in the snapshot
+                if all(core.openflow.getConnection(d) is not None
+                       for d in (link.dpid1, link.dpid2)):
+                    self.snapshot_links.discard(key)
+                    self.snapshot_dirty = True
+
+        if self.bootstrap:
+            self._update_forwarding()
+
+    def _handle_ConnectionUp(self, event):
+        if not self.bootstrap:
+            return
+        now = time.time()
+        if self.first_connect is None:
+            self.first_connect = now
+        self.connect_time[event.dpid] = now
+        self.flood_state.pop(event.dpid, None)
+        self.route_state.pop(event.dpid, None)
+        if not self.confirmed_links:
+            self._load_bootstrap()
+        self._update_forwarding()
+
+    def _handle_ConnectionDown(self, event):
+        if not self.bootstrap:
+            return
+        self.connect_time.pop(event.dpid, None)
+        self.flood_state.pop(event.dpid, None)
+        self.route_state.pop(event.dpid, None)
+        if not self.connect_time:
+            # Every switch is gone: the next connection starts a new run, with
+            # new host MACs if Mininet was restarted
+            self.first_connect = None
+            self.bootstrap_done = False
+            self.handed_over = False
+            self.bootstrap_mtime = None
+            self.mac_to_port = {}
+            self.bootstrap_switches = set()
+
+    def _load_bootstrap(self):
+        try:
+            mtime = os.path.getmtime(self.bootstrap)
+        except OSError:
+            return
+        if mtime == self.bootstrap_mtime:
+            return
+        try:
+            with open(self.bootstrap) as f:
+                data = json.load(f)
+        except (IOError, ValueError) as e:
+            log.warning("Could not read bootstrap topology %s: %s" % (self.bootstrap, e))
+            return
+        self.bootstrap_mtime = mtime
+
+        # The file replaces what an earlier load put in, except for links
+        # discovery has confirmed since
+        for key in self.bootstrap_links:
+            if key not in self.confirmed_links:
+                (dpid1, port1), (dpid2, port2) = key
+                _remove_edge(dpid1, port1, dpid2, port2)
+        self.bootstrap_links = {}
+        self.snapshot_links = set(self.confirmed_links)
+
+        now = time.time()
+        self.bootstrap_switches = set(data.get('switches', []))
+        for node in self.bootstrap_switches:
+            topo.add_node(node)
+        for link in data.get('links', []):
+            dpid1, port1 = link['dpid1'], link['port1']
+            dpid2, port2 = link['dpid2'], link['port2']
+            key = _link_key(dpid1, port1, dpid2, port2)
+            if key in self.confirmed_links or topo.has_edge(dpid1, dpid2):
+                continue
+            topo.add_edge(dpid1, dpid2, port=port1, weight=1.0 / self.bandwidth)
+            topo.add_edge(dpid2, dpid1, port=port2, weight=1.0 / self.bandwidth)
+            self.bootstrap_links[key] = now
+            self.snapshot_links.add(key)
+            self.bootstrap_switches.update((dpid1, dpid2))
+        # One host per port; later entries win over older MACs left behind
+        # by earlier runs
+        by_location = dict(((host['dpid'], host['port']), host['mac'])
+                           for host in data.get('hosts', []))
+        self.bootstrap_hosts = dict((mac, location) for location, mac in by_location.items())
+        self.bootstrap_switches.update(dpid for dpid, port in by_location)
+        log.info("Loaded bootstrap topology from %s: %d switches, %d links, %d hosts" %
+                 (self.bootstrap, len(data.get('switches', [])), len(self.bootstrap_links),
+                  len(self.bootstrap_hosts)))
+
+    def _switch_ports(self):
+        ports = set()
+        for u, v, data in topo.edges(data=True):
+            ports.add((u, data['port']))
+        return ports
+
+    def _host_ports(self):
+        switch_ports = self._switch_ports()
+        ports = set(self.bootstrap_hosts.values()) | set(self.mac_to_port.values())
+        return ports - switch_ports
+
+    def _learn_host(self, mac, location):
+        """Where a host actually shows up wins over the topology file, and
+        replaces whatever MAC the file had on that port (Mininet hands out
+        new MACs on every run)."""
+        if self.bootstrap_hosts.get(mac) == location:
+            return
+        stale = [m for m, loc in self.bootstrap_hosts.items() if loc == location]
+        if mac not in self.bootstrap_hosts and not stale:
+            return
+        if location in self._switch_ports():
+            return
+        for m in stale:
+            del self.bootstrap_hosts[m]
+        self.bootstrap_hosts[mac] = location
+        self.mac_to_port[mac] = location
+        self.snapshot_dirty = True
+        self._update_forwarding()
+
+    def _host_location(self, mac):
+        if mac in self.mac_to_port:
+            return self.mac_to_port[mac]
+        return self.bootstrap_hosts.get(mac)
+
+    def _broadcast_tree(self):
+        graph = nx.Graph()
+        graph.add_nodes_from(sorted(topo.nodes))
+        graph.add_edges_from(sorted((min(u, v), max(u, v)) for u, v in topo.edges))
+        tree = set()
+        for component in nx.connected_components(graph):
+            for u, v in nx.bfs_edges(graph, min(component)):
+                tree.add((u, v))
+                tree.add((v, u))
+        return tree
+
+    def _update_forwarding(self):
+        """Bring every connected switch in line with the known topology.
+
+        Broadcasts follow a spanning tree by disabling flooding on every
+        other port that is not a host port, and until discovery hands over,
+        known hosts get destination-based unicast flows. Only changes against
+        what was last sent are pushed.
+        """
+        tree = self._broadcast_tree()
+        for connection in core.openflow.connections:
+            dpid = connection.dpid
+            if dpid not in self.connect_time:
+                continue
+            self._update_flooding(connection, tree)
+            self._update_routes(connection)
+        self._check_bootstrap_done()
+
+    def _update_flooding(self, connection, tree):
+        dpid = connection.dpid
+        state = self.flood_state.setdefault(dpid, {})
+        tree_ports = {}
+        if dpid in topo:
+            for neighbor in topo.neighbors(dpid):
+                tree_ports[topo[dpid][neighbor]['port']] = (dpid, neighbor) in tree
+        host_ports = self._host_ports()
+        settled = time.time() - self.connect_time[dpid] > 2 * self.link_timeout
+
+        for port in connection.ports.values():
+            port_no = port.port_no
+            if port_no >= of.OFPP_MAX:
+                continue
+            if port_no in tree_ports:
+                no_flood = not tree_ports[port_no]
+            elif (dpid, port_no) in host_ports:
+                no_flood = False
+            else:
+                # May lead to a switch the file doesn't know about; only flood
+                # once discovery has had time to find a link there
+                no_flood = not settled
+            if state.get(port_no) == no_flood:
+                continue
+            msg = of.ofp_port_mod(port_no=port_no,
+                                  hw_addr=port.hw_addr,
+                                  config=of.OFPPC_NO_FLOOD if no_flood else 0,
+                                  mask=of.OFPPC_NO_FLOOD)
+            connection.send(msg)
+            state[port_no] = no_flood
+            log.debug("%s flooding on %s.%i" % ("Disabled" if no_flood else "Enabled",
+                                               dpid_to_str(dpid), port_no))
+
+    def _update_routes(self, connection):
+        if self.handed_over:
+            return
+        dpid = connection.dpid
+        old = self.route_state.get(dpid, {})
+        new = {}
+        paths = {}
+        if dpid in topo:
+            paths = nx.single_source_dijkstra_path(topo, dpid, weight='weight')
+        for mac, (host_dpid, host_port) in self.bootstrap_hosts.items():
+            if host_dpid == dpid:
+                new[mac] = host_port
+            elif host_dpid in paths:
+                path = paths[host_dpid]
+                new[mac] = topo[path[0]][path[1]]['port']
+
+        for mac, port_no in new.items():
+            if old.get(mac) == port_no:
+                continue
+            msg = of.ofp_flow_mod()
+            msg.match.dl_dst = EthAddr(mac)
+            msg.priority = BOOTSTRAP_PRIORITY
+            msg.cookie = BOOTSTRAP_COOKIE
+            msg.hard_timeout = BOOTSTRAP_HARD_TIMEOUT
+            msg.actions.append(of.ofp_action_output(port=port_no))
+            connection.send(msg)
+        for mac in set(old) - set(new):
+            self._delete_route(connection, mac)
+        self.route_state[dpid] = new
+
+    def _delete_route(self, connection, mac):
+        msg = of.ofp_flow_mod(command=of.OFPFC_DELETE_STRICT)
+        msg.match.dl_dst = EthAddr(mac)
+        msg.priority = BOOTSTRAP_PRIORITY
+        connection.send(msg)
+
+    def _hand_over(self):
+        """Remove the proactive routes so PacketIn and install_path take over."""
+        for connection in core.openflow.connections:
+            for mac in self.route_state.get(connection.dpid, {}):
+                self._delete_route(connection, mac)
+        self.route_state = {}
+        self.handed_over = True
+        log.info("Discovery confirmed the bootstrap topology, switching to reactive routing")
+
+    def _check_bootstrap_done(self):
+        if self.bootstrap_done or self.handed_over or self.first_connect is None:
+            return
+        expected = self.bootstrap_switches | set(self.connect_time)
+        if not expected or not expected <= set(self.route_state):
+            return
+        self.bootstrap_done = True
+        log.info("Bootstrap flows installed on %d switches %.3f s after first connection" %
+                 (len(expected), time.time() - self.first_connect))
+
+    def _reconcile(self):
+        """Drop bootstrap links LLDP never confirmed, hand routing back to
+        install_path once the rest are confirmed and save the snapshot."""
+        now = time.time()
+        grace = 2 * self.link_timeout
+        stale = []
+        gone = set()
+        for key, loaded in self.bootstrap_links.items():
+            if key in self.confirmed_links:
+                continue
+            missing = _link_dpids(key) - set(self.connect_time)
+            if missing:
+                # A switch that has not connected within the grace period of
+                # this run is taken to be gone from the network
+                if self.first_connect is None or now - max(loaded, self.first_connect) <= grace:
+                    continue
+                gone.update(missing)
+            elif now - max([loaded] + [self.connect_time[d] for d in _link_dpids(key)]) <= grace:
+                continue
+            stale.append(key)
+        for key in stale:
+            (dpid1, port1), (dpid2, port2) = key
+            log.info("Bootstrap link %s.%i <-> %s.%i not confirmed by discovery, removing" %
+                     (dpid_to_str(dpid1), port1, dpid_to_str(dpid2), port2))
+            del self.bootstrap_links[key]
+            self.snapshot_links.discard(key)
+            _remove_edge(dpid1, port1, dpid2, port2)
+            self.snapshot_dirty = True
+        for dpid in gone:
+            log.info("Switch %s from the bootstrap topology is not connected, removing" %
+                     dpid_to_str(dpid))
+            if dpid in topo:
+                topo.remove_node(dpid)
+            self.bootstrap_switches.discard(dpid)
+            self.snapshot_links = set(k for k in self.snapshot_links if dpid not in _link_dpids(k))
+            self.bootstrap_hosts = dict((mac, loc) for mac, loc in self.bootstrap_hosts.items()
+                                        if loc[0] != dpid)
+
+        # Also opens flooding on ports discovery found no link on in time
+        self._update_forwarding()
+        unconfirmed = [k for k in self.bootstrap_links if k not in self.confirmed_links]
+        if self.connect_time and not self.handed_over:
+            if not unconfirmed:
+                self._hand_over()
+            elif now - self.first_connect >= BOOTSTRAP_HARD_TIMEOUT - self.update_interval:
+                # The proactive flows are about to expire on the switches
+                log.info("%d bootstrap links still unconfirmed" % len(unconfirmed))
+                self._hand_over()
+        if self.snapshot_dirty:
+            self._save_snapshot()
+
+    def _save_snapshot(self):
+        # With no switch connected there is nothing new to record, and the
+        # file may just have been rewritten by topos/topo.py
+        if not self.connect_time:
+            return
+        switch_ports = self._switch_ports()
+        for key in self.snapshot_links:
+            switch_ports.update(key)
+        # Keyed by port so a MAC learned this run replaces an older one there
+        by_location = dict((location, mac) for mac, location in self.bootstrap_hosts.items())
+        for mac, location in self.mac_to_port.items():
+            if location not in switch_ports:
+                by_location[location] = mac
+        hosts = dict((mac, location) for location, mac in by_location.items())
+        switches = self.bootstrap_switches | set(self.connect_time)
+        for key in self.snapshot_links:
+            switches.update(_link_dpids(key))
+        data = {
+            'switches': sorted(switches),
+            'links': [{'dpid1': d1, 'port1': p1, 'dpid2': d2, 'port2': p2}
+                      for (d1, p1), (d2, p2) in sorted(self.snapshot_links)],
+            'hosts': [{'mac': mac, 'dpid': dpid, 'port': port_no}
+                      for mac, (dpid, port_no) in sorted(hosts.items())],
+        }
+        tmp = self.bootstrap + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp, self.bootstrap)
+        except OSError as e:
+            log.warning("Could not save topology snapshot %s: %s" % (self.bootstrap, e))
+            return
+        self.bootstrap_mtime = os.path.getmtime(self.bootstrap)
+        self.snapshot_dirty = False
 
     def _handle_PacketIn(self, event):
         packet = event.parsed
@@ -47,9 +427,13 @@ class DijkstraController(EventMixin):
 
         if src not in self.mac_to_port:
             self.mac_to_port[src] = (dpid, in_port)
+
+        if self.bootstrap:
+            self._learn_host(src, (dpid, in_port))
         
-        if dst in self.mac_to_port:
-            dst_dpid, dst_port = self.mac_to_port[dst]
+        dst_location = self._host_location(dst)
+        if dst_location is not None:
+            dst_dpid, dst_port = dst_location
             if dpid in topo.nodes and dst_dpid in topo.nodes:
                 try:
                     path = nx.shortest_path(topo, dpid, dst_dpid, weight='weight', method='dijkstra')
@@ -105,9 +489,20 @@ class DijkstraController(EventMixin):
                     if topo[dpid][neighbor]['port'] == port_no:
                         topo[dpid][neighbor]['weight'] = weight
 
-def launch():
+def launch(bootstrap=None):
+    """
+    Without arguments, loops are broken by spanning_tree once discovery has
+    converged. With --bootstrap=<topology.json> the known topology is
+    installed as soon as switches connect and reconciled with discovery.
+    """
+    if bootstrap is not None and not isinstance(bootstrap, str):
+        raise RuntimeError("--bootstrap needs a topology file, e.g. --bootstrap=topology.json")
     from pox.openflow.discovery import launch as discovery_launch
     from pox.openflow.spanning_tree import launch as stp_launch
-    discovery_launch(link_timeout=15, eat_early_packets=True)
-    stp_launch()
-    core.registerNew(DijkstraController)
+    link_timeout = 15
+    if bootstrap:
+        discovery_launch(link_timeout=link_timeout, eat_early_packets=False)
+    else:
+        discovery_launch(link_timeout=link_timeout, eat_early_packets=True)
+        stp_launch()
+    core.registerNew(DijkstraController, bootstrap, link_timeout)
@@ -4,12 +4,14 @@ from mininet.node import RemoteController
 from mininet.cli import CLI
 from mininet.log import setLogLevel
 from mininet.link import TCLink
+import argparse
+import json
 import time
 
 class CustomTopo(Topo):
-    def build(self):
+    def build(self, stp=True):
         hosts = [self.addHost(f'h{i + 1}') for i in range(5)]
-        switches = [self.addSwitch(f's{i + 1}', stp=True) for i in range(5)]
+        switches = [self.addSwitch(f's{i + 1}', stp=stp) for i in range(5)]
         
         # Switch-to-switch links
         self.addLink(switches[0], switches[1], bw=300, delay=10)
@@ -24,13 +26,54 @@ class CustomTopo(Topo):
         self.addLink(hosts[3], switches[3])
         self.addLink(hosts[4], switches[4])
 
+def dump_topology(net, path):
+    # Ports and MACs are assigned once the network is built, so this can run
+    # before net.start() and be picked up by test_controller --bootstrap
+    dpids = {switch.name: int(switch.dpid, 16) for switch in net.switches}
+    links, hosts = [], []
+    for link in net.links:
+        intf1, intf2 = link.intf1, link.intf2
+        if intf1.node.name not in dpids:
+            intf1, intf2 = intf2, intf1
+        port1, port2 = intf1.node.ports[intf1], intf2.node.ports[intf2]
+        if intf2.node.name in dpids:
+            links.append({'dpid1': dpids[intf1.node.name], 'port1': port1,
+                          'dpid2': dpids[intf2.node.name], 'port2': port2})
+        else:
+            hosts.append({'mac': intf2.MAC(), 'dpid': dpids[intf1.node.name], 'port': port1})
+
+    with open(path, 'w') as f:
+        json.dump({'switches': sorted(dpids.values()), 'links': links, 'hosts': hosts}, f, indent=2)
+
+def time_to_first_packet(src, dst, start, timeout=120):
+    while time.time() - start < timeout:
+        if ' 1 received' in src.cmd(f'ping -c 1 -W 1 {dst.IP()}'):
+            return time.time() - start
+    return None
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bootstrap', metavar='FILE',
+                        help='write the topology to FILE for test_controller --bootstrap and disable STP')
+    args = parser.parse_args()
+
     setLogLevel('info')
 
-    topo = CustomTopo()
+    topo = CustomTopo(stp=not args.bootstrap)
     net = Mininet(topo=topo, link=TCLink, controller=RemoteController)
+    if args.bootstrap:
+        dump_topology(net, args.bootstrap)
+
+    start = time.time()
     net.start()
 
+    # Time until the first packet makes it across the whole chain
+    elapsed = time_to_first_packet(net.hosts[0], net.hosts[-1], start)
+    if elapsed is None:
+        print(f'No packet forwarded from {net.hosts[0].name} to {net.hosts[-1].name}')
+    else:
+        print(f'Time to first forwarded packet {net.hosts[0].name} -> {net.hosts[-1].name}: {elapsed:.2f}s')
+
     # Start iperf servers on all hosts
     hosts = net.hosts
     for host in hosts: